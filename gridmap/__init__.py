@@ -3,10 +3,38 @@ from flask import Flask
 from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
 from flasgger import Swagger
+from sqlalchemy import event
 
 db = SQLAlchemy()
 cache = Cache()
 
+
+# Configures SQLite connections for write throughput. WAL journaling lets
+# readers and the writer work concurrently, and with WAL it is safe to only
+# sync at checkpoints (synchronous=NORMAL). Temporary tables and indices are
+# kept in memory.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+}
+
+
+def sqlite_pragma_listener(pragmas):
+    """
+    Returns a connect event listener that sets the given *pragmas* (a
+    dictionary of pragma names and values) on each new SQLite connection.
+    """
+
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return set_sqlite_pragma
+
+
 # Based on http://flask.pocoo.org/docs/1.0/tutorial/factory/#the-application-factory
 # Modified to use Flask SQLAlchemy
 def create_app(test_config=None):
@@ -16,6 +44,10 @@ def create_app(test_config=None):
     - a configuration file "config.py" from the local instance folder root
     - the default development configuration hardcoded into this function
     
+    If the REDIS_URL environment variable is set, responses are cached in
+    Redis instead of the instance folder so that all worker processes share
+    the same cache.
+    
     Initiatializiation for the database and cache are done within this
     function. Likewise all CLI commands, converters, and blueprints are
     registered here before the Flask app object is returned.
@@ -29,7 +61,9 @@ def create_app(test_config=None):
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
-        CACHE_TYPE="SimpleCache",
+        CACHE_TYPE="FileSystemCache",
+        CACHE_DIR=os.path.join(app.instance_path, "cache"),
+        SQLITE_PRAGMAS=SQLITE_PRAGMAS,
         SWAGGER={
             "title": "Sensorhub API",
             "openapi": "3.0.4",
@@ -37,6 +71,11 @@ def create_app(test_config=None):
             "doc_dir": "gridmap/doc"
         }
     )
+    if os.environ.get("REDIS_URL"):
+        app.config.update(
+            CACHE_TYPE="RedisCache",
+            CACHE_REDIS_URL=os.environ["REDIS_URL"],
+        )
     
     # Configuration overrides from config file
     if test_config is None:
@@ -51,19 +90,29 @@ def create_app(test_config=None):
     
     db.init_app(app)
     cache.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            event.listen(
+                db.engine,
+                "connect",
+                sqlite_pragma_listener(app.config["SQLITE_PRAGMAS"])
+            )
 
     # Register CLI commands, converters, and blueprint
     # Imports are placed here to avoid circular import issues
     from . import api
     from . import management
     from . import converters
+    from . import utils
     app.cli.add_command(management.init_db_command)
     app.cli.add_command(management.generate_test_data)
     app.cli.add_command(management.update_schemas)
     app.cli.add_command(management.update_docs)
     app.url_map.converters["map"] = converters.MapConverter
     app.url_map.converters["observer"] = converters.ObserverConverter
+    app.url_value_preprocessor(converters.resolve_observer)
     app.register_blueprint(api.api_bp)
     swagger = Swagger(app, template_file="doc/base.yml")
+    utils.build_url_templates(app)
     
     return app
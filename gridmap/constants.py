@@ -3,4 +3,6 @@ MASON = "application/vnd.mason+json"
 MAP_PROFILE = "/profiles/map/"
 OBSERVER_PROFILE = "/profiles/observer/"
 OBSTACLE_PROFILE = "/profiles/obstacle/"
-LINK_RELATIONS = "/link-relations/"
\ No newline at end of file
+LINK_RELATIONS = "/link-relations/"
+JSON_VIEW = "json-view/"
+MASON_VIEW = "mason-view/"
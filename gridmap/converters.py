@@ -12,8 +12,10 @@ instance is passed to *url_for* instead of the model slug, and the converter
 will take care of placing a convertible value into the URI.
 """
 
+from sqlalchemy import select
 from werkzeug.exceptions import NotFound
 from werkzeug.routing import BaseConverter
+from gridmap import db
 from gridmap.models import Map, Observer, Obstacle
 
 class MapConverter(BaseConverter):
@@ -26,7 +28,7 @@ class MapConverter(BaseConverter):
         Converts a map slug into the corresponding map model instance.
         """
         
-        map = Map.query.filter_by(slug=map_slug).first()
+        map = db.session.scalar(select(Map).where(Map.slug == map_slug))
         if map is None:
             raise NotFound
         return map
@@ -41,15 +43,38 @@ class MapConverter(BaseConverter):
         
 class ObserverConverter(BaseConverter):
     """
-    A converter for the Map model. Uses map slug as the resource handle.
+    A converter for the Observer model. Uses observer slug as the resource
+    handle. Observer slugs are only unique within a map, and a converter only
+    sees its own part of the URI, so *to_python* leaves the slug as is. The
+    slug is replaced with the model instance by *resolve_observer* once the
+    map is known.
     """
     
     def to_python(self, obs_slug):
-        observer = Observer.query.filter_by(slug=obs_slug).first()
-        if observer is None:
-            raise NotFound
-        return observer
+        return obs_slug
         
     def to_url(self, observer):
         return observer.slug
+
+
+def resolve_observer(endpoint, values):
+    """
+    URL value preprocessor that replaces the observer slug in the view
+    arguments with the observer model instance from the map given by the
+    map converter. Raises Not Found (404) if the map has no such observer.
+    Needs to be registered to the app with *url_value_preprocessor*.
+    """
+
+    if not values or "observer" not in values:
+        return
+
+    observer = db.session.scalar(
+        select(Observer).where(
+            Observer.map_id == values["map"].id,
+            Observer.slug == values["observer"]
+        )
+    )
+    if observer is None:
+        raise NotFound
+    values["observer"] = observer
     
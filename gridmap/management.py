@@ -4,27 +4,24 @@ This module contains CLI commands for management. Available commands:
 * testgen: populates the database with random data for development purposes
 """
 
-import copy
 import click
-import os.path
-import yaml
-from slugify import slugify
+import os
 from flask import current_app, url_for
 from flask.cli import with_appcontext
+from sqlalchemy import insert, text
 from gridmap import db
 from gridmap.models import Map, Observer, Obstacle
-from gridmap.resources import map, observer, obstacle
 
 TEST_MAP = {
     "name": "Test Map 1",
-    "slug": slugify("Test Map 1"),
+    "slug": "test-map-1",
     "width": 100,
     "height": 80,
 }
 OBSERVERS = [
     {
         "name": f"Test Observer {i}",
-        "slug": slugify(f"Test Observer {i}"),
+        "slug": f"test-observer-{i}",
         "x": x,
         "y": y,
     }
@@ -32,11 +29,40 @@ OBSERVERS = [
 ]
 OBSTACLES = [(5, 5), (20, 20), (50, 50), (70, 70)]
 
+_yaml_backend = None
+
 class literal_unicode(str): pass
 
 def literal_unicode_representer(dumper, data):
-    return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='|')
-yaml.add_representer(literal_unicode, literal_unicode_representer)
+    return dumper.represent_scalar(u'tag:yaml.org,2002:str', str(data), style='|')
+
+def yaml_backend():
+    """
+    Imports PyYAML on first use and returns a (yaml, Loader, Dumper) tuple.
+    Uses libyaml bindings when PyYAML has been built with them. Only the
+    documentation commands need YAML, so other commands and the app itself
+    don't pay for the import.
+    """
+
+    global _yaml_backend
+    if _yaml_backend is None:
+        import yaml
+        Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+        Dumper.add_representer(literal_unicode, literal_unicode_representer)
+        _yaml_backend = (yaml, Loader, Dumper)
+    return _yaml_backend
+
+def replace_file(path, text):
+    """
+    Writes *text* into a temporary file next to *path* and renames it over
+    *path*, so that an interrupted command never leaves a half written file.
+    """
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as target:
+        target.write(text)
+    os.replace(tmp_path, path)
 
 
 @click.command("init-db")
@@ -52,26 +78,27 @@ def init_db_command():
 @with_appcontext
 def generate_test_data():
     """
-    Creates random data that can be used for manual testing while developing.
-    Creates a single map and places 3 observers and 3 obstacles in random
-    positions on the map.
+    Creates test data that can be used for manual testing while developing.
+    Creates a single map and places the observers and obstacles defined in
+    *OBSERVERS* and *OBSTACLES* on the map. Positions are fixed so that the
+    generated data is the same on every run.
     """
-    
-    
-    map = Map(**TEST_MAP)
 
-    for data in OBSERVERS :
-        observer = Observer(**data)
-        map.observers.append(observer)
-
-    for x, y in OBSTACLES:
-        obstacle = Obstacle(
-            x=x,
-            y=y,
-        )
-        map.obstacles.append(obstacle)
+    if db.engine.dialect.name == "sqlite":
+        db.session.execute(text("PRAGMA cache_size=-64000"))
 
+    map = Map(**TEST_MAP)
     db.session.add(map)
+    db.session.flush()
+
+    db.session.execute(
+        insert(Observer),
+        [dict(data, map_id=map.id) for data in OBSERVERS]
+    )
+    db.session.execute(
+        insert(Obstacle),
+        [{"x": x, "y": y, "map_id": map.id} for x, y in OBSTACLES]
+    )
     db.session.commit()
 
 
@@ -79,64 +106,78 @@ def generate_test_data():
 
 @click.command("update-schemas")
 def update_schemas():
+    yaml, Loader, Dumper = yaml_backend()
 
-    with open("gridmap/doc/base.yml") as source:
-        doc = yaml.safe_load(source)
+    with open("gridmap/doc/base.yml", "rb") as source:
+        doc = yaml.load(source.read(), Loader=Loader)
     schemas = doc["components"]["schemas"] = {}
     for cls in [Map, Observer, Obstacle]:
         schemas[cls.__name__] = cls.json_schema()
 
     doc["info"]["description"] = literal_unicode(doc["info"]["description"])
-    with open("gridmap/doc/base.yml", "w") as target:
-        target.write("---\n")
-        target.write(yaml.dump(doc, default_flow_style=False))
+    replace_file(
+        "gridmap/doc/base.yml",
+        "---\n" + yaml.dump(doc, Dumper=Dumper, default_flow_style=False)
+    )
 
 @click.command("update-docs")
 @with_appcontext
 def update_docs():
+    from gridmap.resources import map, observer, obstacle
+
+    yaml, Loader, Dumper = yaml_backend()
     DOC_ROOT = "./gridmap/doc/"
-    GET_TEMPLATE = {
-        "responses": {
-            "200": {
-                "content": {
-                    "application/json": {},
-                    "application/vnd.mason+json": {}
+
+    def get_template():
+        return {
+            "responses": {
+                "200": {
+                    "content": {
+                        "application/json": {},
+                        "application/vnd.mason+json": {}
+                    }
                 }
             }
         }
-    }
-    POST_PUT_TEMPLATE = {
-        "requestBody": {
-            "content": {
-                "application/json": {
-                    "schema": {}
+
+    def put_template():
+        return {
+            "requestBody": {
+                "content": {
+                    "application/json": {
+                        "schema": {}
+                    }
                 }
             }
         }
-    }
-    POST_TEMPLATE = POST_PUT_TEMPLATE.copy()
-    POST_TEMPLATE["responses"] = {
-        "201": {
-            "headers": {
-                "Location": {
-                    "description": "URI of the created resource",
-                    "schema": {
-                        "type": "string"
+
+    def post_template():
+        template = put_template()
+        template["responses"] = {
+            "201": {
+                "headers": {
+                    "Location": {
+                        "description": "URI of the created resource",
+                        "schema": {
+                            "type": "string"
+                        }
                     }
                 }
             }
         }
-    }
-    DELETE_TEMPLATE = {
-        "responses": {
-            "204": {
-                "description": "Successfully deleted"
-            },
-            "404": {
-                "description": "Object not found"
+        return template
+
+    def delete_template():
+        return {
+            "responses": {
+                "204": {
+                    "description": "Successfully deleted"
+                },
+                "404": {
+                    "description": "Object not found"
+                }
             }
         }
-    }
 
     resource_classes = [
         map.MapCollection, map.MapItem, map.MapObservers, map.MapObstacles,
@@ -146,19 +187,22 @@ def update_docs():
 
     client = current_app.test_client()
 
-    def read_or_create(path, template={}):
+    def read_or_create(path, template_factory):
         if os.path.exists(path):
-            with open(path) as source:
-                doc = yaml.safe_load(source)
+            with open(path, "rb") as source:
+                doc = yaml.load(source.read(), Loader=Loader)
         else:
-            doc = copy.deepcopy(template)
+            doc = template_factory()
 
         return doc
 
     def write_doc(path, content):
-        with open(path, "w") as target:
-            target.write("---\n")
-            target.write(yaml.dump(doc, default_flow_style=False))
+        replace_file(path, "---\n" + yaml.dump(
+            content,
+            Dumper=Dumper,
+            default_flow_style=False,
+            sort_keys=False
+        ))
 
     for cls in resource_classes:
         endpoint = cls.__name__.lower()
@@ -166,7 +210,7 @@ def update_docs():
         os.makedirs(endpoint_path, exist_ok=True)
         if hasattr(cls, "get"):
             doc_path = os.path.join(endpoint_path, "get.yml")
-            doc = read_or_create(doc_path, GET_TEMPLATE)
+            doc = read_or_create(doc_path, get_template)
             uri = url_for(
                 "api." + endpoint,
                 map=Map(**TEST_MAP),
@@ -184,7 +228,7 @@ def update_docs():
 
         if hasattr(cls, "post"):
             doc_path = os.path.join(endpoint_path, "post.yml")
-            doc = read_or_create(doc_path, POST_TEMPLATE)
+            doc = read_or_create(doc_path, post_template)
             doc["requestBody"]["content"]["application/json"]["schema"]["$ref"] = (
                 f"#/components/schemas/{cls.child_model.__name__}"
             )
@@ -192,7 +236,7 @@ def update_docs():
 
         if hasattr(cls, "put"):
             doc_path = os.path.join(endpoint_path, "put.yml")
-            doc = read_or_create(doc_path, POST_PUT_TEMPLATE)
+            doc = read_or_create(doc_path, put_template)
             doc["requestBody"]["content"]["application/json"]["schema"]["$ref"] = (
                 f"#/components/schemas/{cls.model.__name__}"
             )
@@ -200,7 +244,7 @@ def update_docs():
 
         if hasattr(cls, "delete"):
             doc_path = os.path.join(endpoint_path, "delete.yml")
-            doc = read_or_create(doc_path, DELETE_TEMPLATE)
+            doc = read_or_create(doc_path, delete_template)
             write_doc(doc_path, doc)
 
 
@@ -3,14 +3,63 @@ This module includes all database models used in the map inventory service.
 SQLAlchemy is used to manage the models. Each model has utility methods to
 serialize and deserialize between model instances and dictionaries. In
 addition, each model class has a class method for retrieving a JSON schema
-corresponding to the model.
+corresponding to the model, and another for retrieving a precompiled validator
+for that schema.
 """
 
-from flask import url_for
+from functools import lru_cache
+from typing import Optional
+from jsonschema import Draft7Validator
+from sqlalchemy import Float, ForeignKey, String
+from sqlalchemy.orm import Mapped, mapped_column, validates
 from gridmap import db
 from gridmap.constants import MAP_PROFILE, OBSERVER_PROFILE
-from gridmap.utils import MapBuilder
-from slugify import slugify
+from gridmap.utils import MapBuilder, cached_url_for
+from slugify import slugify as _slugify
+
+# Names are short and the same name is slugified over and over again (e.g.
+# repeated PUTs with an unchanged name), so results are memoized.
+slugify = lru_cache(maxsize=4096)(_slugify)
+
+
+@lru_cache(maxsize=256)
+def _bounded_validator(model, width, height):
+    """
+    Builds a validator for *model*'s JSON schema where the x and y
+    coordinates are also limited to a map of *width* x *height* tiles.
+    Validators are cached by map size because most maps share a handful of
+    sizes.
+    """
+
+    schema = model.json_schema()
+    properties = dict(schema["properties"])
+    properties["x"] = dict(properties["x"], maximum=width - 1)
+    properties["y"] = dict(properties["y"], maximum=height - 1)
+    return Draft7Validator(dict(schema, properties=properties))
+
+
+MAP_SCHEMA = {
+    "type": "object",
+    "required": ["name", "width", "height"],
+    "properties": {
+        "name": {
+            "description": "Name for the map (unique)",
+            "type": "string",
+            "maxLength": 32
+        },
+        "width": {
+            "description": "Map width",
+            "type": "integer",
+            "minimum": 1
+        },
+        "height": {
+            "description": "Map height",
+            "type": "integer",
+            "minimum": 1
+        },
+    }
+}
+MAP_VALIDATOR = Draft7Validator(MAP_SCHEMA)
 
 
 class Map(db.Model):
@@ -25,7 +74,7 @@ class Map(db.Model):
     Maps have four columns.
     * *id* (int) 
     * *name* (str) - map name, max 32 characters
-    * *slug* (str) - slugified name
+    * *slug* (str) - slugified name, set automatically when name is set
     * *width* (int) - map width (tiles)
     * *height* (int) - map height (tiles)
     
@@ -34,18 +83,18 @@ class Map(db.Model):
     * *obstacles* - all obstacles on the map
     """
     
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(32), unique=True, nullable=False)
-    slug = db.Column(db.String(32), unique=True, nullable=False, index=True)
-    width = db.Column(db.Integer, nullable=False)
-    height= db.Column(db.Integer, nullable=False)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(32), unique=True)
+    slug: Mapped[str] = mapped_column(String(32), unique=True, index=True)
+    width: Mapped[int]
+    height: Mapped[int]
     
-    observers = db.relationship(
+    observers: Mapped[list["Observer"]] = db.relationship(
         "Observer",
         back_populates="map",
         cascade="all, delete-orphan"
     )
-    obstacles = db.relationship(
+    obstacles: Mapped[list["Obstacle"]] = db.relationship(
         "Obstacle",
         back_populates="map",
         cascade="all, delete-orphan"
@@ -53,6 +102,16 @@ class Map(db.Model):
     
     def __repr__(self) -> str:
         return f"{self.name} <{self.id}> ({self.width} x {self.height})"
+
+    @validates("name")
+    def _set_slug(self, key, name):
+        """
+        Keeps *slug* in sync with *name*. Whenever the name is set, the slug is
+        set to its slugified form, so callers never need to set it themselves.
+        """
+
+        self.slug = slugify(name)
+        return name
         
     def serialize(self,
                   include_relations=False,
@@ -68,50 +127,90 @@ class Map(db.Model):
         be included in the result. If *primary* is set to False, this object
         will be treated as an item in a listing and will only get a "self"
         control. If it's set to True, full controls for changing the map will
-        be included.
+        be included. Listing items are plain dictionaries with the "self"
+        control written in directly, only primary objects use MapBuilder.
+        
+        Each kind of representation is built by its own specialized method,
+        this method only picks the right one.
         """
     
-        if use_mason:
-            body = MapBuilder()
-            body.add_control("self", url_for("api.mapitem", map=self))
-            if primary:
-                body.add_control("collection", url_for("api.mapcollection"))
-                body.add_control_edit_map(self, self.json_schema())
-                body.add_control_delete_map(self)
-                body.add_control("profile", MAP_PROFILE)
-                body.add_control_create_observer(self, Observer.json_schema())
-                body.add_control_create_obstacle(self, Obstacle.json_schema())
+        if not use_mason:
+            body = self._serialize_plain()
+        elif primary:
+            body = self._serialize_mason_primary()
         else:
-            body = {}
-            
-        body.update({
+            body = self._serialize_mason_item()
+        if include_relations:
+            self._serialize_relations(body, use_mason, primary)
+        return body
+
+    def _serialize_plain(self) -> dict:
+        """
+        Serializes the map's own columns without hypermedia controls.
+        """
+
+        return {
             "name": self.name,
             "slug": self.slug,
             "width": self.width,
             "height": self.height,
-        })
-        if include_relations:
-            observers = []
-            for observer in self.observers:
-                observers.append(observer.serialize(use_mason=use_mason))
-            obstacles = []            
-            for obstacle in self.obstacles:
-                obstacles.append(obstacle.serialize(use_mason=use_mason))
-            body["observers"] = observers
-            body["obstacles"] = obstacles
-        if use_mason:
-            pass
+        }
+
+    def _serialize_mason_item(self) -> dict:
+        """
+        Serializes the map as an item in a listing, i.e. with the "self"
+        control only.
+        """
+
+        return {
+            "@controls": {
+                "self": {"href": cached_url_for("api.mapitem", map=self)}
+            },
+            **self._serialize_plain()
+        }
+
+    def _serialize_mason_primary(self) -> MapBuilder:
+        """
+        Serializes the map as the primary object of a response, i.e. with
+        all of its controls.
+        """
+
+        body = MapBuilder()
+        body.add_control("self", cached_url_for("api.mapitem", map=self))
+        body.add_control("collection", cached_url_for("api.mapcollection"))
+        body.add_control_edit_map(self, self.json_schema())
+        body.add_control_delete_map(self)
+        body.add_control("profile", MAP_PROFILE)
+        body.add_control_create_observer(self, Observer.json_schema())
+        body.add_control_create_obstacle(self, Obstacle.json_schema())
+        body.update(self._serialize_plain())
         return body
+
+    def _serialize_relations(self, body, use_mason, primary):
+        """
+        Adds the observer and obstacle arrays to a serialized map *body*.
+        """
+
+        body["observers"] = [
+            observer.serialize(use_mason=use_mason)
+            for observer in self.observers
+        ]
+        if use_mason and primary:
+            body.add_bulk_obstacle_delete_controls(self, self.obstacles)
+        else:
+            body["obstacles"] = [
+                obstacle.serialize(use_mason=use_mason)
+                for obstacle in self.obstacles
+            ]
         
     def update_from_dict(self, object_dict):
         """
         Updates this model instance from a dictionary with matching keys. Note
-        that slug will be updated from the "name" key using slugify - "slug"
-        key will be ignored even if set.
+        that slug will be updated from the "name" key by the name validator -
+        "slug" key will be ignored even if set.
         """
     
         self.name = object_dict["name"]
-        self.slug = slugify(object_dict["name"])
         self.width = object_dict["width"]
         self.height = object_dict["height"]
         
@@ -126,7 +225,6 @@ class Map(db.Model):
         
         return cls(
             name=object_dict["name"],
-            slug=slugify(object_dict["name"]),
             width=object_dict["width"],
             height=object_dict["height"]
         )
@@ -134,41 +232,63 @@ class Map(db.Model):
     @staticmethod
     def json_schema() -> dict:
         """
-        Static method for getting the model's respective JSON schema. This
-        method simply constructs the schema as a Python dictionary. 
+        Static method for getting the model's respective JSON schema. The
+        schema is a module level constant that is built once on import, and
+        the same dictionary is returned on every call. Callers must not modify
+        it.
         
         NOTE: This is only done for the sake of keeping things simple - in a
         real life solution schemas should be generated from the model
         declaration.
         """
         
-        props = {}
-        props["name"] = {
-            "description": "Name for the map (unique)",
+        return MAP_SCHEMA
+
+    @staticmethod
+    def json_validator() -> Draft7Validator:
+        """
+        Static method for getting a validator for the model's JSON schema. The
+        validator is compiled once on import, so validating a request body
+        doesn't need to build a new one every time.
+        """
+
+        return MAP_VALIDATOR
+
+
+OBSERVER_SCHEMA = {
+    "type": "object",
+    "required": ["name", "x", "y"],
+    "properties": {
+        "name": {
+            "description": "Name for referencing the observer (unique per map)",
             "type": "string",
             "maxLength": 32
-        }
-        props["width"] = {
-            "description": "Map width",
+        },
+        "vision": {
+            "description": "Observer's vision range (infinite if omitted)",
+            "type": "number",
+            "minimum": 0
+        },
+        "x": {
+            "description": "Observer's x coordinate",
             "type": "integer",
-            "minimum": 1
-        }
-        props["height"] = {
-            "description": "Map height",
+            "minimum": 0
+        },
+        "y": {
+            "description": "Observer's y coordinate",
             "type": "integer",
-            "minimum": 1
-        }    
-        return {
-            "type": "object",
-            "required": ["name", "width", "height"],
-            "properties": props
-        }
-        
+            "minimum": 0
+        },
+    }
+}
+OBSERVER_VALIDATOR = Draft7Validator(OBSERVER_SCHEMA)
+
 
 class Observer(db.Model):
     """
     Model that represents an observer on a map. Observers are indexed by slugs
-    derived from names, and observer names are unique. Observers can have an
+    derived from names, and observer slugs are unique per map (two different
+    maps can both have an observer with the same name). Observers can have an
     optional limited range of vision. Observers will be deleted along with the
     map they are on.
     
@@ -179,7 +299,7 @@ class Observer(db.Model):
     Observer columns:
     * *id* (int) 
     * *name* (str) - observer name, max 32 characters
-    * *slug* (str) - slugified name
+    * *slug* (str) - slugified name, set automatically when name is set
     * *vision* (float) - observer's vision range (optional)
     * *map_id* (int) - foreign key to map id 
     * *x (int) - observer's x coordinate on the map
@@ -187,25 +307,41 @@ class Observer(db.Model):
     
     Relationships:
     * *map* - reference to the map
+    
+    The map is usually already present in the session because it was loaded
+    by the map converter, in which case accessing *map* is served from the
+    identity map without a new SELECT.
     """
     
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(32), unique=True, nullable=False)
-    slug = db.Column(db.String(32), unique=True, nullable=False, index=True)
-    vision = db.Column(db.Float, nullable=True)
-    map_id = db.Column(
-        db.Integer,
-        db.ForeignKey("map.id", ondelete="CASCADE"),
-        nullable=False
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(32))
+    slug: Mapped[str] = mapped_column(String(32))
+    vision: Mapped[Optional[float]] = mapped_column(Float)
+    map_id: Mapped[int] = mapped_column(
+        ForeignKey("map.id", ondelete="CASCADE")
     )
-    x = db.Column(db.Integer, nullable=False)
-    y = db.Column(db.Integer, nullable=False)
+    x: Mapped[int]
+    y: Mapped[int]
     
-    map = db.relationship("Map", back_populates="observers")
+    map: Mapped["Map"] = db.relationship(back_populates="observers")
+
+    __table_args__ = (
+        db.UniqueConstraint("map_id", "slug", name="uq_observer_map_slug"),
+    )
 
     def __repr__(self) -> str:
         return f"{self.name} <{self.id}> @ ({self.x}, {self.y})"
 
+    @validates("name")
+    def _set_slug(self, key, name):
+        """
+        Keeps *slug* in sync with *name*. Whenever the name is set, the slug is
+        set to its slugified form, so callers never need to set it themselves.
+        """
+
+        self.slug = slugify(name)
+        return name
+
     def serialize(self,
                   include_relations=False,
                   use_mason=False,
@@ -215,21 +351,37 @@ class Observer(db.Model):
         columns that are intended to be accessible through the API. If
         *include_relations* is set, will also include slug and name of the map
         this observer is placed in. If *use_mason* is set, hypermedia controls
-        will be included in the result.
+        will be included in the result. As with maps, only a *primary* object
+        gets the full set of controls through MapBuilder, listing items are
+        plain dictionaries with a "self" control.
         """
         
-        if use_mason:
+        if not use_mason and not include_relations:
+            return {
+                "name": self.name,
+                "slug": self.slug,
+                "vision": self.vision,
+                "x": self.x,
+                "y": self.y
+            }
+
+        if use_mason and primary:
             body = MapBuilder()
-            body.add_control("self", url_for(
-                "api.observeritem", 
+            body.add_control("self", cached_url_for(
+                "api.observeritem",
                 map=self.map,
                 observer=self
             ))
-            if primary:
-                body.add_control("up", url_for("api.mapitem", map=self.map))
-                body.add_control_edit_observer(self, self.json_schema())
-                body.add_control_delete_observer(self)
-                body.add_control("profile", OBSERVER_PROFILE)
+            body.add_control("up", cached_url_for("api.mapitem", map=self.map))
+            body.add_control_edit_observer(self, self.json_schema())
+            body.add_control_delete_observer(self)
+            body.add_control("profile", OBSERVER_PROFILE)
+        elif use_mason:
+            body = {"@controls": {"self": {"href": cached_url_for(
+                "api.observeritem",
+                map=self.map,
+                observer=self
+            )}}}
         else:
             body = {}
 
@@ -248,12 +400,11 @@ class Observer(db.Model):
     def update_from_dict(self, object_dict):
         """
         Updates this model instance from a dictionary with matching keys. Note
-        that slug will be updated from the "name" key using slugify - "slug"
-        key will be ignored even if set.
+        that slug will be updated from the "name" key by the name validator -
+        "slug" key will be ignored even if set.
         """
 
         self.name = object_dict["name"]
-        self.slug = slugify(object_dict["name"])
         self.vision = object_dict.get("vision")
         self.x = object_dict["x"]
         self.y = object_dict["y"]
@@ -270,7 +421,6 @@ class Observer(db.Model):
         
         return cls(
             name=object_dict["name"],
-            slug=slugify(object_dict["name"]),
             vision=object_dict.get("vision"),
             x=object_dict["x"],
             y=object_dict["y"]
@@ -279,75 +429,94 @@ class Observer(db.Model):
     @staticmethod
     def json_schema() -> dict:
         """
-        Static method for getting the model's respective JSON schema. This
-        method simply constructs the schema as a Python dictionary. 
+        Static method for getting the model's respective JSON schema. The
+        schema is a module level constant that is built once on import, and
+        the same dictionary is returned on every call. Callers must not modify
+        it.
         
         NOTE: This is only done for the sake of keeping things simple - in a
         real life solution schemas should be generated from the model
         declaration.
         """
         
-        props = {}
-        props["name"] = {
-            "description": "Name for referencing the observer (unique per map)",
-            "type": "string",
-            "maxLength": 32
-        }
-        props["vision"] = {
-            "description": "Observer's vision range (infinite if omitted)",
-            "type": "number",
-            "minimum": 0
-        }
-        props["x"] = {
-            "description": "Observer's x coordinate",
+        return OBSERVER_SCHEMA
+
+    @staticmethod
+    def json_validator() -> Draft7Validator:
+        """
+        Static method for getting a validator for the model's JSON schema. The
+        validator is compiled once on import, so validating a request body
+        doesn't need to build a new one every time.
+        """
+
+        return OBSERVER_VALIDATOR
+
+    @classmethod
+    def json_validator_for_map(cls, map) -> Draft7Validator:
+        """
+        Class method for getting a validator that, in addition to the model's
+        JSON schema, checks that the coordinates are within *map*. Validators
+        are built on first use for each map size.
+        """
+
+        return _bounded_validator(cls, map.width, map.height)
+
+
+OBSTACLE_SCHEMA = {
+    "type": "object",
+    "required": ["x", "y"],
+    "properties": {
+        "x": {
+            "description": "Obstacles's x coordinate (closest to origin)",
             "type": "integer",
             "minimum": 0
-        }
-        props["y"] = {
-            "description": "Observer's y coordinate",
+        },
+        "y": {
+            "description": "Obstacles's y coordinate (closest to origin)",
             "type": "integer",
             "minimum": 0
-        }
-        return {
-            "type": "object",
-            "required": ["name", "x", "y"],
-            "properties": props
-        }
-        
-        
+        },
+    }
+}
+OBSTACLE_VALIDATOR = Draft7Validator(OBSTACLE_SCHEMA)
+
+
 class Obstacle(db.Model):
     """
     Model that represents an obstacle on a map. Obstacles are only defined by
-    their position on the map. All obstacles are deleted along with the map.
+    their position on the map, and the position is also the primary key: there
+    can only be one obstacle per tile. All obstacles are deleted along with the
+    map.
        
     Validation for numbers is not done on the database level. They will be
     forced in schema validation instead. Validation against map dimensions is
     done in the view method.
        
-    Observer columns:
-    * *id* (int) 
+    On SQLite the table is created WITHOUT ROWID, i.e. rows are stored
+    directly in the primary key B-tree.
+       
+    Obstacle columns (*map_id*, *x* and *y* form the primary key):
     * *map_id* (int) - foreign key to map id 
-    * *x (int) - observer's x coordinate on the map
-    * *y (int) - observer's x coordinate on the map
+    * *x (int) - obstacle's x coordinate on the map
+    * *y (int) - obstacle's y coordinate on the map
     
     Relationships:
     * *map* - reference to the map
     """
 
-    id = db.Column(db.Integer, primary_key=True)
-    map_id = db.Column(
-        db.Integer,
-        db.ForeignKey("map.id",
-        ondelete="CASCADE"),
-        nullable=False
+    map_id: Mapped[int] = mapped_column(
+        ForeignKey("map.id", ondelete="CASCADE"),
+        primary_key=True
     )
-    x = db.Column(db.Integer, nullable=False)
-    y = db.Column(db.Integer, nullable=False)
+    x: Mapped[int] = mapped_column(primary_key=True)
+    y: Mapped[int] = mapped_column(primary_key=True)
     
-    map = db.relationship("Map", back_populates="obstacles")
+    map: Mapped["Map"] = db.relationship(back_populates="obstacles")
+
+    __table_args__ = {"sqlite_with_rowid": False}
 
     def __repr__(self) -> str:
-        return f"Obstacle <{self.id}> @ ({self.x}, {self.y})"
+        return f"Obstacle <{self.map_id}> @ ({self.x}, {self.y})"
     
     def serialize(self,
                   include_relations=False,
@@ -365,6 +534,9 @@ class Obstacle(db.Model):
         is always included.
         """
 
+        if not use_mason and not include_relations:
+            return {"x": self.x, "y": self.y}
+
         if use_mason:
             body = MapBuilder()
             body.add_control_delete_obstacle(self)
@@ -385,8 +557,8 @@ class Obstacle(db.Model):
         """
         Creates a new Obstacle model instance from a dictionary. The object
         returned by this method can be used to create a new database entry.
-        Notably, *id* is not set by this method. Likewise the map relationship
-        is expected to be created from the view method.
+        Notably, *map_id* is not set by this method. The map relationship is
+        expected to be created from the view method.
         """
         
         return cls(
@@ -397,27 +569,34 @@ class Obstacle(db.Model):
     @staticmethod
     def json_schema() -> dict:
         """
-        Static method for getting the model's respective JSON schema. This
-        method simply constructs the schema as a Python dictionary. 
+        Static method for getting the model's respective JSON schema. The
+        schema is a module level constant that is built once on import, and
+        the same dictionary is returned on every call. Callers must not modify
+        it.
         
         NOTE: This is only done for the sake of keeping things simple - in a
         real life solution schemas should be generated from the model
         declaration.
         """
         
-        props = {}
-        props["x"] = {
-            "description": "Obstacles's x coordinate (closest to origin)",
-            "type": "integer",
-            "minimum": 0
-        }
-        props["y"] = {
-            "description": "Obstacles's y coordinate (closest to origin)",
-            "type": "integer",
-            "minimum": 0
-        }
-        return {
-            "type": "object",
-            "required": ["x", "y"],
-            "properties": props
-        }
+        return OBSTACLE_SCHEMA
+
+    @staticmethod
+    def json_validator() -> Draft7Validator:
+        """
+        Static method for getting a validator for the model's JSON schema. The
+        validator is compiled once on import, so validating a request body
+        doesn't need to build a new one every time.
+        """
+
+        return OBSTACLE_VALIDATOR
+
+    @classmethod
+    def json_validator_for_map(cls, map) -> Draft7Validator:
+        """
+        Class method for getting a validator that, in addition to the model's
+        JSON schema, checks that the coordinates are within *map*. Validators
+        are built on first use for each map size.
+        """
+
+        return _bounded_validator(cls, map.width, map.height)
@@ -2,17 +2,23 @@
 This module contains resources related to map. 
 """
 
-import json
-from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from jsonschema import ValidationError
+from flask import Response, request
 from flask_restful import Resource
 from flask_accept import accept, accept_fallback
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import BadRequest, Conflict, UnsupportedMediaType
+from sqlalchemy import select
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import BadRequest, Conflict
 from gridmap import cache, db
-from gridmap.constants import JSON, MASON, MAP_PROFILE, LINK_RELATIONS
+from gridmap.constants import (
+    MASON, MAP_PROFILE, LINK_RELATIONS, JSON_VIEW, MASON_VIEW
+)
 from gridmap.models import Map, Observer, Obstacle
-from gridmap.utils import MapBuilder
+from gridmap.utils import (
+    MapBuilder, cached_url_for, conditional, json_response,
+    request_json, view_cache_keys
+)
 
 
 class MapCollection(Resource):
@@ -32,13 +38,11 @@ class MapCollection(Resource):
         the post method when a new map is added.
         """
         
-        cache.delete_many((
-            f"json-view/{request.path}",
-            f"mason-view/{request.path}"
-        ))
+        cache.delete_many(*view_cache_keys(request.path))
     
     @accept_fallback
-    @cache.cached(timeout=None, key_prefix="json-view/%s")
+    @conditional
+    @cache.cached(timeout=None, key_prefix=JSON_VIEW + "%s")
     def get(self):
         """
         The GET method for data only JSON. Returns a dictionary with a single
@@ -47,16 +51,21 @@ class MapCollection(Resource):
         contents.
         """
         
-        items = []
-        for db_map in Map.query.all():
-            items.append(db_map.serialize())
+        rows = db.session.execute(
+            select(Map.name, Map.slug, Map.width, Map.height)
+        )
+        items = [
+            {"name": name, "slug": slug, "width": width, "height": height}
+            for name, slug, width, height in rows
+        ]
         body = {
             "maps": items
         }
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return json_response(body)
         
     @get.support("application/vnd.mason+json")
-    @cache.cached(timeout=None, key_prefix="mason-view/%s")
+    @conditional
+    @cache.cached(timeout=None, key_prefix=MASON_VIEW + "%s")
     def get_mason(self):
         """
         The GET method for Mason. The data part of the dictionary is a single
@@ -68,17 +77,18 @@ class MapCollection(Resource):
         maps, and accessing the map profile.
         """
 
-        items = []
-        for db_map in Map.query.all():
-            items.append(db_map.serialize(use_mason=True))
+        db_maps = Map.query.options(
+            load_only(Map.name, Map.slug, Map.width, Map.height)
+        ).all()
+        items = [db_map.serialize(use_mason=True) for db_map in db_maps]
         body = MapBuilder(
             maps=items
         )
         body.add_namespace("pwp-map", LINK_RELATIONS)
-        body.add_control("self", url_for("api.mapcollection"))
+        body.add_control("self", cached_url_for("api.mapcollection"))
         body.add_control_create_map(schema=Map.json_schema())
         body.add_control("profile", MAP_PROFILE)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return json_response(body, MASON)
         
     def post(self):
         """
@@ -92,26 +102,25 @@ class MapCollection(Resource):
         * Conflict (409) - if an integrity error occurs while saving to DB
         """
     
-        if not request.json:
-            raise UnsupportedMediaType
+        payload = request_json()
 
         try:
-            validate(request.json, Map.json_schema())
+            Map.json_validator().validate(payload)
         except ValidationError as e:
             raise BadRequest(description=str(e))
         
-        map = Map.deserialize(request.json)
+        map = Map.deserialize(payload)
         try:
             db.session.add(map)
             db.session.commit()
         except IntegrityError:
             raise Conflict(
                 description="A map named '{name}' already exists".format(
-                    **request.json
+                    **payload
             ))
         self._clean_cache()
         return Response(status=201, headers={
-            "Location": url_for("api.mapitem", map=map)
+            "Location": cached_url_for("api.mapitem", map=map)
         })
 
 
@@ -141,16 +150,14 @@ class MapItem(Resource):
         changed or a map is deleted.
         """
         
-        collection_path = url_for("api.mapcollection")
-        cache.delete_many((
-            f"json-view/{collection_path}",
-            f"mason-view/{collection_path}",
-            f"json-view/{request.path}",
-            f"mason-view/{request.path}"
+        cache.delete_many(*view_cache_keys(
+            cached_url_for("api.mapcollection"),
+            request.path
         ))
 
     @accept_fallback
-    @cache.cached(timeout=None, key_prefix="json-view/%s")
+    @conditional
+    @cache.cached(timeout=None, key_prefix=JSON_VIEW + "%s")
     def get(self, map):
         """
         The GET method for data only JSON. Returns a dictionary with map
@@ -160,10 +167,11 @@ class MapItem(Resource):
         """
         
         body = map.serialize(include_relations=True)
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return json_response(body)
         
     @get.support("application/vnd.mason+json")
-    @cache.cached(timeout=None, key_prefix="mason-view/%s")
+    @conditional
+    @cache.cached(timeout=None, key_prefix=MASON_VIEW + "%s")
     def get_mason(self, map):
         """
         The GET method for Mason. Returns a dictionary with map attributes, and
@@ -182,7 +190,7 @@ class MapItem(Resource):
             primary=True
         )
         body.add_namespace("pwp-map", LINK_RELATIONS)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return json_response(body, MASON)
         
     def put(self, map):
         """
@@ -195,22 +203,21 @@ class MapItem(Resource):
         * Conflict (409) - if an integrity error occurs while saving to DB
         """
     
-        if not request.json:
-            raise UnsupportedMediaType
+        payload = request_json()
 
         try:
-            validate(request.json, Map.json_schema())
+            Map.json_validator().validate(payload)
         except ValidationError as e:
             raise BadRequest(description=str(e))
 
-        map.update_from_dict(request.json)
+        map.update_from_dict(payload)
         try:
             db.session.add(map)
             db.session.commit()
         except IntegrityError:
             raise Conflict(
                 description="A map named '{name}' already exists".format(
-                    **request.json
+                    **payload
             ))
         self._clean_cache()
         return Response(status=204)
@@ -241,10 +248,8 @@ class MapObservers(Resource):
         : param object parent: the map object that was added to
         """
 
-        parent_path = url_for("api.mapitem", map=parent)
-        cache.delete_many((
-            f"json-view/{parent_path}",
-            f"mason-view/{parent_path}",
+        cache.delete_many(*view_cache_keys(
+            cached_url_for("api.mapitem", map=parent)
         ))
 
     def post(self, map):
@@ -255,35 +260,36 @@ class MapObservers(Resource):
         
         The following exceptions are possible:
         * Unsupported Media Type (415) - when the request body is not JSON
-        * Bad Request (400) - if validation against schema fails
+        * Bad Request (400) - if validation against schema fails, or the
+          observer would be outside the map
         * Conflict (409) - if an integrity error occurs while saving to DB
         """
     
-        if not request.json:
-            raise UnsupportedMediaType
+        payload = request_json()
 
         try:
-            validate(request.json, Observer.json_schema())
+            Observer.json_validator_for_map(map).validate(payload)
         except ValidationError as e:
             raise BadRequest(description=str(e))
         
-        observer = Observer.deserialize(request.json)
-        if 0 <= observer.x < map.width and 0 <= observer.y < map.height:
-            map.observers.append(observer)
-        else:
-            raise BadRequest(description="Observer is outside map")
+        observer = Observer.deserialize(payload)
+        observer.map = map
         
         try:
-            db.session.add(map)
+            db.session.add(observer)
             db.session.commit()
         except IntegrityError:
             raise Conflict(
                 description="An observer named '{name}' already exists".format(
-                    **request.json
+                    **payload
             ))
         self._clean_cache(map)
         return Response(status=201, headers={
-            "Location": url_for("api.observeritem", map=map, observer=observer),
+            "Location": cached_url_for(
+                "api.observeritem",
+                map=map,
+                observer=observer
+            ),
         })
 
 
@@ -301,10 +307,8 @@ class MapObstacles(Resource):
         : param object parent: the map object that was added to
         """
 
-        parent_path = url_for("api.mapitem", map=parent)
-        cache.delete_many((
-            f"json-view/{parent_path}",
-            f"mason-view/{parent_path}",
+        cache.delete_many(*view_cache_keys(
+            cached_url_for("api.mapitem", map=parent)
         ))
 
     def post(self, map):
@@ -317,29 +321,33 @@ class MapObstacles(Resource):
         
         The following exceptions are possible:
         * Unsupported Media Type (415) - when the request body is not JSON
-        * Bad Request (400) - if validation against schema fails
+        * Bad Request (400) - if validation against schema fails, or the
+          obstacle would be outside the map
         * Conflict (409) - if an integrity error occurs while saving to DB
         """
 
-        if not request.json:
-            raise UnsupportedMediaType
+        payload = request_json()
 
         try:
-            validate(request.json, Obstacle.json_schema())
+            Obstacle.json_validator_for_map(map).validate(payload)
         except ValidationError as e:
             raise BadRequest(description=str(e))
         
-        obstacle = Obstacle.deserialize(request.json)
-        if 0 <= obstacle.x < map.width and 0 <= obstacle.y < map.height:
-            map.obstacles.append(obstacle)
-        else:
-            raise BadRequest(description="Obstacle is outside map")
-        
-        db.session.add(map)
-        db.session.commit()
+        obstacle = Obstacle.deserialize(payload)
+        occupied = "An obstacle already exists at ({x}, {y})".format(
+            **payload
+        )
+        if db.session.get(Obstacle, (map.id, obstacle.x, obstacle.y)):
+            raise Conflict(description=occupied)
+        obstacle.map = map
+        try:
+            db.session.add(obstacle)
+            db.session.commit()
+        except IntegrityError:
+            raise Conflict(description=occupied)
         self._clean_cache(map)
         return Response(status=201, headers={
-            "Location": url_for(
+            "Location": cached_url_for(
                 "api.obstacleitem",
                 map=map,
                 x=obstacle.x,
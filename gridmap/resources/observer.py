@@ -2,17 +2,21 @@
 This module contains the observer resource.
 """
 
-import json
-from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from jsonschema import ValidationError
+from flask import Response, request
 from flask_restful import Resource
 from flask_accept import accept, accept_fallback
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import BadRequest, Conflict, UnsupportedMediaType
+from werkzeug.exceptions import BadRequest, Conflict
 from gridmap import cache, db
-from gridmap.constants import JSON, MASON, OBSERVER_PROFILE, LINK_RELATIONS
+from gridmap.constants import (
+    MASON, OBSERVER_PROFILE, LINK_RELATIONS, JSON_VIEW, MASON_VIEW
+)
 from gridmap.models import Map, Observer, Obstacle
-from gridmap.utils import MapBuilder
+from gridmap.utils import (
+    MapBuilder, cached_url_for, conditional, json_response,
+    request_json, view_cache_keys
+)
 
 class ObserverItem(Resource):
     """
@@ -38,16 +42,14 @@ class ObserverItem(Resource):
         : param object parent: the map that contains the observer
         """
 
-        parent_path = url_for("api.mapitem", map=parent)
-        cache.delete_many((
-            f"json-view/{parent_path}",
-            f"mason-view/{parent_path}",
-            f"json-view/{request.path}",
-            f"mason-view/{request.path}"
+        cache.delete_many(*view_cache_keys(
+            cached_url_for("api.mapitem", map=parent),
+            request.path
         ))
     
     @accept_fallback
-    @cache.cached(timeout=None, key_prefix="json-view/%s")
+    @conditional
+    @cache.cached(timeout=None, key_prefix=JSON_VIEW + "%s")
     def get(self, map, observer):
         """
         The GET method for data only JSON. Returns a dictionary with observer
@@ -55,10 +57,11 @@ class ObserverItem(Resource):
         """
         
         body = observer.serialize(include_relations=True)
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return json_response(body)
         
     @get.support("application/vnd.mason+json")
-    @cache.cached(timeout=None, key_prefix="mason-view/%s")
+    @conditional
+    @cache.cached(timeout=None, key_prefix=MASON_VIEW + "%s")
     def get_mason(self, map, observer):
         """
         The GET method for Mason. Returns a dictionary with observer
@@ -69,7 +72,7 @@ class ObserverItem(Resource):
         
         body = observer.serialize(use_mason=True, primary=True)
         body.add_namespace("pwp-map", LINK_RELATIONS)
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return json_response(body, MASON)
         
     def put(self, map, observer):
         """
@@ -78,30 +81,26 @@ class ObserverItem(Resource):
         
         The following exceptions are possible:
         * Unsupported Media Type (415) - when the request body is not JSON
-        * Bad Request (400) - if validation against schema fails
+        * Bad Request (400) - if validation against schema fails, or the
+          observer would be outside the map
         * Conflict (409) - if an integrity error occurs while saving to DB
         """
 
-        if not request.json:
-            raise UnsupportedMediaType
+        payload = request_json()
 
         try:
-            validate(request.json, Observer.json_schema())
+            Observer.json_validator_for_map(map).validate(payload)
         except ValidationError as e:
             raise BadRequest(description=str(e))
 
-        observer.update_from_dict(request.json)
-        if 0 <= observer.x < map.width and 0 <= observer.y < map.height:
-            pass
-        else:
-            raise BadRequest(description="Observer is outside map")
+        observer.update_from_dict(payload)
         try:
             db.session.add(observer)
             db.session.commit()
         except IntegrityError:
             raise Conflict(
                 description="An observer named '{name}' already exists".format(
-                    **request.json
+                    **payload
             ))
         self._clean_cache(map)
         return Response(status=204)
@@ -4,14 +4,16 @@ This module contains the obstacle resource
 
 import json
 from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from flask import Response, request
 from flask_restful import Resource
 from flask_accept import accept
+from sqlalchemy import delete
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, Conflict, UnsupportedMediaType
 from gridmap import cache, db
 from gridmap.constants import JSON, MASON, MAP_PROFILE
 from gridmap.models import Obstacle
+from gridmap.utils import cached_url_for, view_cache_keys
 
 class ObstacleItem(Resource):
     """
@@ -32,17 +34,23 @@ class ObstacleItem(Resource):
         : param object parent: the map object that was added to
         """
 
-        parent_path = url_for("api.mapitem", map=parent)
-        cache.delete_many((
-            f"json-view/{parent_path}",
-            f"mason-view/{parent_path}",
+        cache.delete_many(*view_cache_keys(
+            cached_url_for("api.mapitem", map=parent)
         ))
 
     def delete(self, map, x, y):
         """
         Removes on obstacle from the given map at given coordinates.
+        Idempotent.
         """
         
-        Obstacle.query.filter_by(map_id=map.id, x=x, y=y).delete()
+        db.session.execute(
+            delete(Obstacle).where(
+                Obstacle.map_id == map.id,
+                Obstacle.x == x,
+                Obstacle.y == y
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
         self._clean_cache(map)
         return Response(status=204)
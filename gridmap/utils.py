@@ -1,4 +1,156 @@
-from flask import url_for
+import hashlib
+import orjson
+import re
+from functools import wraps
+from flask import Response, g, has_request_context, request, url_for
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+from werkzeug.routing.rules import parse_converter_args
+from gridmap.constants import JSON, JSON_VIEW, MASON_VIEW
+
+dumps = orjson.dumps
+loads = orjson.loads
+URL_TEMPLATES = {}
+VIEW_CACHE_PREFIXES = (JSON_VIEW, MASON_VIEW)
+_RULE_ARGUMENT = re.compile(r"<(?:(\w+)(?:\((.*?)\))?:)?(\w+)>")
+
+
+def build_url_templates(app):
+    """
+    Turns the URL rules of *app* into format string templates that are stored
+    into *URL_TEMPLATES* by endpoint, e.g. "/api/maps/<map:map>/" becomes
+    "/api/maps/{map}/". Each template is stored together with the converters
+    of its arguments. Endpoints with more than one rule are left out because
+    the right rule depends on the values given. This function needs to be
+    called after all blueprints have been registered.
+    """
+
+    seen = set()
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint in seen:
+            URL_TEMPLATES.pop(rule.endpoint, None)
+            continue
+        seen.add(rule.endpoint)
+        converters = {}
+        for match in _RULE_ARGUMENT.finditer(rule.rule):
+            name, args, argument = match.groups()
+            args, kwargs = parse_converter_args(args) if args else ((), {})
+            converters[argument] = app.url_map.converters[name or "default"](
+                app.url_map, *args, **kwargs
+            )
+        URL_TEMPLATES[rule.endpoint] = (
+            _RULE_ARGUMENT.sub(r"{\3}", rule.rule),
+            converters
+        )
+
+
+def fast_url(endpoint, **values):
+    """
+    Builds a URI for *endpoint* by formatting the template created by
+    *build_url_templates*, using the converters' *to_url* for the values just
+    like *url_for* does. This skips Werkzeug's rule matching and building
+    which is considerably slower. Falls back to *url_for* outside requests,
+    for unknown endpoints, and when the values don't match the rule's
+    arguments exactly (e.g. extra values that would go to the query string).
+    """
+
+    template = URL_TEMPLATES.get(endpoint)
+    if template is None or not has_request_context():
+        return url_for(endpoint, **values)
+    path, converters = template
+    if values.keys() != converters.keys():
+        return url_for(endpoint, **values)
+    return request.script_root + path.format(**{
+        name: converters[name].to_url(value) for name, value in values.items()
+    })
+
+
+def cached_url_for(endpoint, **values):
+    """
+    Memoized version of *url_for* (using *fast_url*) for building URIs while
+    serializing a response. URIs are stored in *g* for the duration of the
+    request, keyed by the endpoint and the URL values. Model instances are
+    keyed by their slug. Listings and full Mason documents need the same URIs
+    several times (e.g. the map URI for every observer on the map), and each
+    one is only built once this way.
+    """
+
+    url_cache = g.setdefault("url_cache", {})
+    key = (endpoint,) + tuple(
+        (name, getattr(value, "slug", value)) for name, value in values.items()
+    )
+    url = url_cache.get(key)
+    if url is None:
+        url = url_cache[key] = fast_url(endpoint, **values)
+    return url
+
+
+def payload_etag(payload):
+    """
+    Computes an ETag for the serialized response body *payload* (bytes).
+    Uses a short BLAKE2b digest, which is faster than the SHA-1 that
+    *Response.add_etag* uses and plenty for telling representations apart.
+    """
+
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+def request_json():
+    """
+    Parses the request body as JSON straight from the raw bytes. Raises
+    Unsupported Media Type (415) if the request doesn't declare a JSON body
+    or the body is empty, and Bad Request (400) if the body can't be parsed.
+    """
+
+    if not request.is_json:
+        raise UnsupportedMediaType
+    raw = request.get_data(cache=False)
+    if not raw:
+        raise UnsupportedMediaType
+    try:
+        return loads(raw)
+    except ValueError:
+        raise BadRequest(description="Request body is not valid JSON")
+
+
+def json_response(body, content_type=JSON):
+    """
+    Serializes *body* into a 200 response with an ETag computed from the
+    payload. The content type defaults to JSON; Mason views pass *MASON*.
+    """
+
+    payload = dumps(body)
+    response = Response(payload, 200, headers={"Content-Type": content_type})
+    response.set_etag(payload_etag(payload))
+    return response
+
+
+def view_cache_keys(*paths):
+    """
+    Returns the cache keys of both the JSON and the Mason view of each of the
+    resource *paths*. The result is meant to be unpacked into
+    *cache.delete_many*, which takes the keys as separate arguments.
+    """
+
+    return tuple(
+        prefix + path for path in paths for prefix in VIEW_CACHE_PREFIXES
+    )
+
+
+def conditional(view):
+    """
+    Decorator for GET view methods that turns the response into a conditional
+    one. If the request's If-None-Match header matches the ETag of the
+    response, the client's copy is still valid and 304 Not Modified is sent
+    instead of the body. The view is expected to set the ETag, and this
+    decorator should be placed above *cache.cached* so that the ETag is only
+    computed when the response is generated, not on every cache hit.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return view(*args, **kwargs).make_conditional(request)
+    return wrapper
+
 
 class MasonBuilder(dict):
     """
@@ -59,11 +211,8 @@ class MasonBuilder(dict):
         : param str href: target URI for the control
         """
 
-        if "@controls" not in self:
-            self["@controls"] = {}
-
-        self["@controls"][ctrl_name] = kwargs
-        self["@controls"][ctrl_name]["href"] = href
+        kwargs["href"] = href
+        self.setdefault("@controls", {})[ctrl_name] = kwargs
         
     def add_control_post(self, ctrl_name, title, href, schema):
         """
@@ -143,7 +292,7 @@ class MapBuilder(MasonBuilder):
         self.add_control_post(
             "pwp-map:create-map",
             "Create a new map",
-            url_for("api.mapcollection"),
+            cached_url_for("api.mapcollection"),
             schema
         )
         
@@ -155,7 +304,7 @@ class MapBuilder(MasonBuilder):
 
         self.add_control_put(
             "Update this map",
-            url_for("api.mapitem", map=map),
+            cached_url_for("api.mapitem", map=map),
             schema
         )
         
@@ -166,7 +315,7 @@ class MapBuilder(MasonBuilder):
     
         self.add_control_delete(
             "Delete this map",
-            url_for("api.mapitem", map=map),
+            cached_url_for("api.mapitem", map=map),
         )
         
     def add_control_create_observer(self, map, schema):
@@ -178,7 +327,7 @@ class MapBuilder(MasonBuilder):
         self.add_control_post(
             "pwp-map:create-observer",
             "Place a new observer on this map",
-            url_for("api.mapobservers", map=map),
+            cached_url_for("api.mapobservers", map=map),
             schema
         )
         
@@ -191,7 +340,7 @@ class MapBuilder(MasonBuilder):
         self.add_control_post(
             "pwp-map:create-obstacle",
             "Place a new obstacle on this map",
-            url_for("api.mapobstacles", map=map),
+            cached_url_for("api.mapobstacles", map=map),
             schema
         )
     
@@ -203,7 +352,11 @@ class MapBuilder(MasonBuilder):
         
         self.add_control_put(
             "Update this observer",
-            url_for("api.observeritem", map=observer.map, observer=observer),
+            cached_url_for(
+                "api.observeritem",
+                map=observer.map,
+                observer=observer
+            ),
             schema
         )
         
@@ -214,7 +367,11 @@ class MapBuilder(MasonBuilder):
 
         self.add_control_delete(
             "Delete this observer",
-            url_for("api.observeritem", map=observer.map, observer=observer),
+            cached_url_for(
+                "api.observeritem",
+                map=observer.map,
+                observer=observer
+            ),
         )
         
     def add_control_delete_obstacle(self, obstacle):
@@ -224,10 +381,35 @@ class MapBuilder(MasonBuilder):
 
         self.add_control_delete(
             "Delete this obstacle",
-            url_for(
+            cached_url_for(
                 "api.obstacleitem",
                 map=obstacle.map,
                 x=obstacle.x,
                 y=obstacle.y
             ),
         )
+
+    def add_bulk_obstacle_delete_controls(self, map, obstacles):
+        """
+        Adds the "obstacles" array of *map* to the object. Each item is a
+        serialized obstacle with a control for deleting it, i.e. the same
+        result as serializing each obstacle with *use_mason*. The obstacle
+        collection URI is built only once, and item URIs are formed by
+        appending the coordinates to it instead of calling *url_for* for each
+        obstacle.
+        """
+
+        base = cached_url_for("api.mapobstacles", map=map)
+        self["obstacles"] = [
+            {
+                "@controls": {
+                    self.DELETE_RELATION: {
+                        "method": "DELETE",
+                        "title": "Delete this obstacle",
+                        "href": f"{base}{obstacle.x}/{obstacle.y}/",
+                    }
+                },
+                **obstacle.serialize()
+            }
+            for obstacle in obstacles
+        ]
@@ -1,4 +1,4 @@
-import json
+from http import HTTPStatus
 from tests.utils import *
     
 
@@ -14,14 +14,14 @@ class TestMapCollection(JsonApiPostTestBase, MasonApiTestBase):
     def valid_item_json(self):
         return {
             "name": f"Valid Map A",
-            "width": random.randint(10, 50),
-            "height": random.randint(10, 50),
+            "width": RNG.randint(10, 50),
+            "height": RNG.randint(10, 50),
         }
         
     def test_get(self, client):
         resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/json"})
-        assert resp.status_code == 200
-        body = json.loads(resp.data)
+        assert resp.status_code == HTTPStatus.OK
+        body = loads(resp.data)
         assert len(body["maps"]) == 3
         for item in body["maps"]:
             assert "name" in item
@@ -33,8 +33,8 @@ class TestMapCollection(JsonApiPostTestBase, MasonApiTestBase):
             
     def test_mason_get(self, client):
         resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json"})
-        assert resp.status_code == 200
-        body = json.loads(resp.data)
+        assert resp.status_code == HTTPStatus.OK
+        body = loads(resp.data)
         assert "pwp-map" in body["@namespaces"]
         assert "profile" in body["@controls"]
         self._check_control_post_method("pwp-map:create-map", client, body)
@@ -48,7 +48,18 @@ class TestMapCollection(JsonApiPostTestBase, MasonApiTestBase):
             assert "observers" not in item
             assert "obstacles" not in item
             self._check_control_get_method("self", client, item)
-        
+
+    def test_post_clears_cache(self, client):
+        accepts = ["application/json", "application/vnd.mason+json"]
+        for accept in accepts:
+            resp = client.get(self.RESOURCE_URL, headers={"Accept": accept})
+            assert len(loads(resp.data)["maps"]) == 3
+        resp = client.post(self.RESOURCE_URL, json=self.valid_item_json())
+        assert resp.status_code == HTTPStatus.CREATED
+        for accept in accepts:
+            resp = client.get(self.RESOURCE_URL, headers={"Accept": accept})
+            assert len(loads(resp.data)["maps"]) == 4
+
 
 class TestMapItem(JsonApiPutTestBase, JsonApiDeleteTestBase, MasonApiTestBase):
     
@@ -63,14 +74,14 @@ class TestMapItem(JsonApiPutTestBase, JsonApiDeleteTestBase, MasonApiTestBase):
     def valid_json(self):
         return {
             "name": f"Valid Map A",
-            "width": random.randint(10, 50),
-            "height": random.randint(10, 50),
+            "width": RNG.randint(10, 50),
+            "height": RNG.randint(10, 50),
         }
         
     def test_get(self, client):
         resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/json"})
-        assert resp.status_code == 200
-        body = json.loads(resp.data)
+        assert resp.status_code == HTTPStatus.OK
+        body = loads(resp.data)
         assert "name" in body
         assert "slug" in body
         assert "width" in body
@@ -82,8 +93,8 @@ class TestMapItem(JsonApiPutTestBase, JsonApiDeleteTestBase, MasonApiTestBase):
 
     def test_mason_get(self, client):
         resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json"})
-        assert resp.status_code == 200
-        body = json.loads(resp.data)
+        assert resp.status_code == HTTPStatus.OK
+        body = loads(resp.data)
         assert "name" in body
         assert "slug" in body
         assert "width" in body
@@ -98,16 +109,41 @@ class TestMapItem(JsonApiPutTestBase, JsonApiDeleteTestBase, MasonApiTestBase):
             self._check_control_get_method("self", client, observer)
         for obstacle in body["obstacles"]:
             self._check_control_delete_method("pwp-map:delete", client, obstacle)
-        
-    def test_mason_put(self, client):
-        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json"})
-        body = json.loads(resp.data)
-        self._check_control_put_method("edit", client, body)
 
-    def test_mason_delete(self, client):
-        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json"})
-        body = json.loads(resp.data)
-        self._check_control_delete_method("pwp-map:delete", client, body)
+    def test_mason_put(self, client, mason_body):
+        self._check_control_put_method("edit", client, mason_body)
+
+    def test_mason_delete(self, client, mason_body):
+        self._check_control_delete_method("pwp-map:delete", client, mason_body)
+
+    def test_get_not_modified(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == HTTPStatus.NOT_MODIFIED
+        assert resp.data == b""
+
+    def test_get_etag_after_put(self, client):
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        resp = client.put(
+            self.RESOURCE_URL,
+            json={"name": "Test Map 1", "width": 60, "height": 45}
+        )
+        assert resp.status_code == HTTPStatus.NO_CONTENT
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == HTTPStatus.OK
+        assert resp.headers["ETag"] != etag
+
+    def test_get_etag_per_view(self, client):
+        json_resp = client.get(
+            self.RESOURCE_URL,
+            headers={"Accept": "application/json"}
+        )
+        mason_resp = client.get(
+            self.RESOURCE_URL,
+            headers={"Accept": "application/vnd.mason+json"}
+        )
+        assert json_resp.headers["ETag"] != mason_resp.headers["ETag"]
 
 
 class TestMapObserverCollection(JsonApiPostTestBase, MasonApiTestBase):
@@ -122,8 +158,8 @@ class TestMapObserverCollection(JsonApiPostTestBase, MasonApiTestBase):
     def valid_item_json(self):
        return {
             "name": f"Valid Observer A",
-            "x": random.randint(0, 9),
-            "y": random.randint(0, 9),
+            "x": RNG.randint(0, 9),
+            "y": RNG.randint(0, 9),
         }
         
     def test_post_control(self, client):
@@ -131,9 +167,28 @@ class TestMapObserverCollection(JsonApiPostTestBase, MasonApiTestBase):
             TestMapItem.RESOURCE_URL,
             headers={"Accept": "application/vnd.mason+json"}
         )
-        body = json.loads(resp.data)
+        body = loads(resp.data)
         self._check_control_post_method("pwp-map:create-observer", client, body)
-        
+
+    def test_post_same_name_other_map(self, client):
+        valid = {"name": "Test Observer 1", "x": 1, "y": 2}
+        resp = client.post("/api/maps/test-map-2/observers/", json=valid)
+        assert resp.status_code == HTTPStatus.CREATED
+        resp = client.post("/api/maps/test-map-2/observers/", json=valid)
+        assert resp.status_code == HTTPStatus.CONFLICT
+        for map_url, x, y in [
+                ("/api/maps/test-map-1/", 0, 0),
+                ("/api/maps/test-map-2/", 1, 2)]:
+            resp = client.get(
+                map_url + "observers/test-observer-1/",
+                headers={"Accept": "application/vnd.mason+json"}
+            )
+            assert resp.status_code == HTTPStatus.OK
+            body = loads(resp.data)
+            assert body["@controls"]["up"]["href"] == map_url
+            assert body["x"] == x
+            assert body["y"] == y
+
         
 class TestMapObstacleCollection(JsonApiPostTestBase, MasonApiTestBase):
 
@@ -141,7 +196,7 @@ class TestMapObstacleCollection(JsonApiPostTestBase, MasonApiTestBase):
     ITEM_URL = "/api/maps/test-map-1/obstacles/5/5/"
     REQUIRED_FIELDS = ["x", "y"]
     INVALID_VALUES = OBS_INVALID_VALUES
-    TEST_UNIQUE = False
+    TEST_UNIQUE = True
     VERIFY_ITEM = False
      
     def valid_item_json(self):
@@ -155,7 +210,7 @@ class TestMapObstacleCollection(JsonApiPostTestBase, MasonApiTestBase):
             TestMapItem.RESOURCE_URL,
             headers={"Accept": "application/vnd.mason+json"}
         )
-        body = json.loads(resp.data)
+        body = loads(resp.data)
         self._check_control_post_method("pwp-map:create-obstacle", client, body)
 
 
@@ -173,14 +228,14 @@ class TestObserverItem(JsonApiPutTestBase, JsonApiDeleteTestBase, MasonApiTestBa
     def valid_json(self):
         return {
             "name": f"Valid Observer A",
-            "x": random.randint(0, 9),
-            "y": random.randint(0, 9),
+            "x": RNG.randint(0, 9),
+            "y": RNG.randint(0, 9),
         }
         
     def test_get(self, client):
         resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/json"})
-        assert resp.status_code == 200
-        body = json.loads(resp.data)
+        assert resp.status_code == HTTPStatus.OK
+        body = loads(resp.data)
         assert "name" in body
         assert "slug" in body
         assert "vision" in body
@@ -189,8 +244,8 @@ class TestObserverItem(JsonApiPutTestBase, JsonApiDeleteTestBase, MasonApiTestBa
 
     def test_mason_get(self, client):
         resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json"})
-        assert resp.status_code == 200
-        body = json.loads(resp.data)
+        assert resp.status_code == HTTPStatus.OK
+        body = loads(resp.data)
         assert "name" in body
         assert "slug" in body
         assert "vision" in body
@@ -201,15 +256,11 @@ class TestObserverItem(JsonApiPutTestBase, JsonApiDeleteTestBase, MasonApiTestBa
         self._check_control_get_method("self", client, body)
         self._check_control_get_method("up", client, body)
 
-    def test_mason_put(self, client):
-        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json"})
-        body = json.loads(resp.data)
-        self._check_control_put_method("edit", client, body)
+    def test_mason_put(self, client, mason_body):
+        self._check_control_put_method("edit", client, mason_body)
 
-    def test_mason_delete(self, client):
-        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json"})
-        body = json.loads(resp.data)
-        self._check_control_delete_method("pwp-map:delete", client, body)
+    def test_mason_delete(self, client, mason_body):
+        self._check_control_delete_method("pwp-map:delete", client, mason_body)
 
 
 class TestObstacleItem(JsonApiDeleteTestBase):
@@ -0,0 +1,19 @@
+"""
+Pytest hooks for the API tests.
+"""
+
+
+def pytest_generate_tests(metafunc):
+    """
+    Parametrizes the invalid request tests of the API test base classes with
+    the *REQUIRED_FIELDS* and *INVALID_VALUES* attributes of the concrete test
+    class, so that each field and each invalid value is a separate test.
+    """
+
+    if "missing_field" in metafunc.fixturenames:
+        metafunc.parametrize("missing_field", metafunc.cls.REQUIRED_FIELDS)
+    if "invalid_field" in metafunc.fixturenames:
+        metafunc.parametrize(
+            ("invalid_field", "invalid_value"),
+            metafunc.cls.INVALID_VALUES
+        )
@@ -3,15 +3,17 @@ This module includes utility classes and functions for API testing.
 """
 
 import json
-import os
 import pytest
 import random
-import tempfile
-from jsonschema import validate
+import sqlite3
+from http import HTTPStatus
+from jsonschema import Draft7Validator
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
-from app import create_app, db
-from app.models import Map, Observer, Obstacle
+from sqlalchemy.pool import StaticPool
+from gridmap import cache, create_app, db
+from gridmap.models import Map, Observer, Obstacle
+from gridmap.utils import loads
 
 
 MAP_INVALID_VALUES = [
@@ -30,6 +32,12 @@ OBS_INVALID_VALUES = [
         ("y", 60)
 ]
 
+# Random test data comes from a seeded generator so that every run uses the
+# same data, and a failing run can be reproduced.
+RNG = random.Random(0)
+
+_VALIDATORS = {}
+
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -41,6 +49,34 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
     cursor.close()
+
+def dispatch_get(app, path, **kwargs):
+    """
+    Dispatches a GET request to *path* directly through the app's request
+    handling and returns the response. Skips the WSGI round trip of the test
+    client, which is unnecessary when only the response status is checked.
+    Keyword arguments are passed to *test_request_context*.
+    """
+
+    with app.test_request_context(path, method="GET", **kwargs):
+        return app.full_dispatch_request()
+
+def schema_validator(schema):
+    """
+    Returns a validator for *schema*. The first time a schema is seen it is
+    checked against the Draft 7 meta-schema, which raises SchemaError for an
+    invalid schema, and the validator is stored. Schemas come from parsed
+    response bodies and are new dictionaries every time, so they are
+    identified by their canonical JSON serialization instead of object
+    identity.
+    """
+
+    key = json.dumps(schema, sort_keys=True)
+    validator = _VALIDATORS.get(key)
+    if validator is None:
+        Draft7Validator.check_schema(schema)
+        validator = _VALIDATORS[key] = Draft7Validator(schema)
+    return validator
     
     
 class JsonApiPostTestBase(object):
@@ -83,15 +119,15 @@ class JsonApiPostTestBase(object):
         
         valid = self.valid_item_json()
         resp = client.post(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 201
+        assert resp.status_code == HTTPStatus.CREATED
         assert resp.headers.get("Location", "").endswith(self.ITEM_URL)
         if self.VERIFY_ITEM:
             resp = client.get(
                 resp.headers["Location"],
                 headers={"Accept": "application/json"}
             )
-            assert resp.status_code == 200
-            body = json.loads(resp.data)
+            assert resp.status_code == HTTPStatus.OK
+            body = loads(resp.data)
             for key, value in valid.items():
                 assert body.get(key) == value
     
@@ -101,38 +137,64 @@ class JsonApiPostTestBase(object):
         response status code is 415.
         """
         
-        valid = self.valid_item_json()
-        resp = client.post(self.RESOURCE_URL, data=json.dumps(valid))
-        assert resp.status_code == 415
+        resp = client.post(
+            self.RESOURCE_URL,
+            data=b"x",
+            content_type="text/plain"
+        )
+        assert resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+    def test_post_malformed_json(self, client):
+        """
+        Tests a POST method with a JSON media type but a request body that
+        is not valid JSON. Asserts that the response status code is 400.
+        """
+
+        resp = client.post(
+            self.RESOURCE_URL,
+            data=b'{"name": ',
+            content_type="application/json"
+        )
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_post_empty_body(self, client):
+        """
+        Tests a POST method with a JSON media type but an empty request
+        body. Asserts that the response status code is 415.
+        """
+
+        resp = client.post(
+            self.RESOURCE_URL,
+            data=b"",
+            content_type="application/json"
+        )
+        assert resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
         
-    def test_post_missing_field(self, client):
+    def test_post_missing_field(self, client, missing_field):
         """
         Tests a POST method with a request body that is missing a required
-        field. Rotates through all of the required fields and tests an
-        otherwise valid request body with each of them missing in turn.
+        field. The test is parametrized with each of the fields in
+        *REQUIRED_FIELDS* in turn, and the field is removed from an otherwise
+        valid request body.
         """
-        
-        valid = self.valid_item_json()
-        for field in self.REQUIRED_FIELDS:
-            invalid = valid.copy()
-            del invalid[field]
-            resp = client.post(self.RESOURCE_URL, json=invalid)
-            assert resp.status_code == 400
+
+        invalid = self.valid_item_json()
+        del invalid[missing_field]
+        resp = client.post(self.RESOURCE_URL, json=invalid)
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
     
-    def test_post_invalid_values(self, client):
+    def test_post_invalid_values(self, client, invalid_field, invalid_value):
         """
-        Tests a POST method with a request body that contains invalid values
-        for fields. Rotates through the invalid field-value pairs in
-        *INVALID_VALUES* and updates and otherwise valid request body with each
-        of the invalid pairs in turn.
+        Tests a POST method with a request body that contains an invalid value
+        for a field. The test is parametrized with each of the field-value
+        pairs in *INVALID_VALUES* in turn, and the pair is set into an
+        otherwise valid request body.
         """
-        
-        valid = self.valid_item_json()
-        for field, value in self.INVALID_VALUES:
-            invalid = valid.copy()
-            invalid[field] = value
-            resp = client.post(self.RESOURCE_URL, json=invalid)
-            assert resp.status_code == 400
+
+        invalid = self.valid_item_json()
+        invalid[invalid_field] = invalid_value
+        resp = client.post(self.RESOURCE_URL, json=invalid)
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
     
     def test_post_duplicate(self, client):
         """
@@ -146,9 +208,9 @@ class JsonApiPostTestBase(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         resp = client.post(self.RESOURCE_URL, json=valid)
         if self.TEST_UNIQUE:
-            assert resp.status_code == 409
+            assert resp.status_code == HTTPStatus.CONFLICT
         else:
-            assert resp.status_code == 201
+            assert resp.status_code == HTTPStatus.CREATED
 
 
 class JsonApiPutTestBase(object):
@@ -192,14 +254,14 @@ class JsonApiPutTestBase(object):
 
         valid = self.valid_json()
         resp = client.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 204
+        assert resp.status_code == HTTPStatus.NO_CONTENT
         if self.VERIFY_ITEM:
             resp = client.get(
                 self.RELOCATED_URL,
                 headers={"Accept": "application/json"}
             )
-            assert resp.status_code == 200
-            body = json.loads(resp.data)
+            assert resp.status_code == HTTPStatus.OK
+            body = loads(resp.data)
             for key, value in valid.items():
                 assert body.get(key) == value
     
@@ -209,38 +271,64 @@ class JsonApiPutTestBase(object):
         response status code is 415.
         """
 
-        valid = self.valid_json()
-        resp = client.put(self.RESOURCE_URL, data=json.dumps(valid))
-        assert resp.status_code == 415
+        resp = client.put(
+            self.RESOURCE_URL,
+            data=b"x",
+            content_type="text/plain"
+        )
+        assert resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+    def test_put_malformed_json(self, client):
+        """
+        Tests a PUT method with a JSON media type but a request body that
+        is not valid JSON. Asserts that the response status code is 400.
+        """
+
+        resp = client.put(
+            self.RESOURCE_URL,
+            data=b'{"name": ',
+            content_type="application/json"
+        )
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_put_empty_body(self, client):
+        """
+        Tests a PUT method with a JSON media type but an empty request
+        body. Asserts that the response status code is 415.
+        """
+
+        resp = client.put(
+            self.RESOURCE_URL,
+            data=b"",
+            content_type="application/json"
+        )
+        assert resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
         
-    def test_put_missing_field(self, client):
+    def test_put_missing_field(self, client, missing_field):
         """
         Tests a PUT method with a request body that is missing a required
-        field. Rotates through all of the required fields and tests an
-        otherwise valid request body with each of them missing in turn.
+        field. The test is parametrized with each of the fields in
+        *REQUIRED_FIELDS* in turn, and the field is removed from an otherwise
+        valid request body.
         """
 
-        valid = self.valid_json()
-        for field in self.REQUIRED_FIELDS:
-            invalid = valid.copy()
-            del invalid[field]
-            resp = client.put(self.RESOURCE_URL, json=invalid)
-            assert resp.status_code == 400
+        invalid = self.valid_json()
+        del invalid[missing_field]
+        resp = client.put(self.RESOURCE_URL, json=invalid)
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
     
-    def test_put_invalid_values(self, client):
+    def test_put_invalid_values(self, client, invalid_field, invalid_value):
         """
-        Tests a POST method with a request body that contains invalid values
-        for fields. Rotates through the invalid field-value pairs in
-        *INVALID_VALUES* and updates and otherwise valid request body with each
-        of the invalid pairs in turn.
+        Tests a PUT method with a request body that contains an invalid value
+        for a field. The test is parametrized with each of the field-value
+        pairs in *INVALID_VALUES* in turn, and the pair is set into an
+        otherwise valid request body.
         """
 
-        valid = self.valid_json()
-        for field, value in self.INVALID_VALUES:
-            invalid = valid.copy()
-            invalid[field] = value
-            resp = client.put(self.RESOURCE_URL, json=invalid)
-            assert resp.status_code == 400
+        invalid = self.valid_json()
+        invalid[invalid_field] = invalid_value
+        resp = client.put(self.RESOURCE_URL, json=invalid)
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
 
     def test_put_duplicate(self, client):
         """
@@ -254,7 +342,7 @@ class JsonApiPutTestBase(object):
             valid = self.valid_json()
             resp = client.put(self.RESOURCE_URL, json=valid)
             resp = client.put(self.RESOURCE_2_URL, json=valid)
-            assert resp.status_code == 409
+            assert resp.status_code == HTTPStatus.CONFLICT
 
 
 class JsonApiDeleteTestBase(object):
@@ -278,10 +366,10 @@ class JsonApiDeleteTestBase(object):
         """
         
         resp = client.delete(self.RESOURCE_URL)
-        assert resp.status_code == 204
+        assert resp.status_code == HTTPStatus.NO_CONTENT
         if self.CONFIRM_DELETE:
             resp = client.get(self.RESOURCE_URL)
-            assert resp.status_code == 404
+            assert resp.status_code == HTTPStatus.NOT_FOUND
 
 
 class MasonApiTestBase(object):
@@ -296,6 +384,24 @@ class MasonApiTestBase(object):
     """
     
     CONFIRM_DELETE = False
+
+    @pytest.fixture(scope="class")
+    @classmethod
+    def mason_body(cls, app, db_snapshot):
+        """
+        Class scoped pytest fixture that fetches the Mason representation of
+        *RESOURCE_URL* once for all tests in the class that only need to read
+        its controls. The database is reset from the snapshot first so that
+        the body doesn't depend on what the previous test did.
+        """
+
+        reset_app(app, db_snapshot)
+        resp = app.test_client().get(
+            cls.RESOURCE_URL,
+            headers={"Accept": "application/vnd.mason+json"}
+        )
+        assert resp.status_code == HTTPStatus.OK
+        return loads(resp.data)
     
     def valid_json(self, **params):
         """
@@ -317,14 +423,20 @@ class MasonApiTestBase(object):
     
     def _check_control_get_method(self, ctrl, client, obj):
         """
-        Tests a control for a GET method by sending a new GET request to the
+        Tests a control for a GET method by dispatching a GET request to the
         URI in the control's "href" attribute using Mason as the accepted
-        media type. Passes if response code 200 is received.
+        media type. Passes if response code 200 is received. The request is
+        dispatched in-process with *dispatch_get* since only the status code
+        is needed.
         """
     
         href = obj["@controls"][ctrl]["href"]
-        resp = client.get(href, headers={"Accept": "application/vnd.mason+json"})
-        assert resp.status_code == 200
+        resp = dispatch_get(
+            client.application,
+            href,
+            headers={"Accept": "application/vnd.mason+json"}
+        )
+        assert resp.status_code == HTTPStatus.OK
         
     def _check_control_delete_method(self, ctrl, client, obj):
         """
@@ -337,10 +449,10 @@ class MasonApiTestBase(object):
         method = obj["@controls"][ctrl]["method"].lower()
         assert method == "delete"
         resp = client.delete(href)
-        assert resp.status_code == 204
+        assert resp.status_code == HTTPStatus.NO_CONTENT
         if self.CONFIRM_DELETE:
             resp = client.get(href)
-            assert resp.status_code == 404
+            assert resp.status_code == HTTPStatus.NOT_FOUND
         
     def _check_control_post_method(self, ctrl, client, obj):
         """
@@ -360,9 +472,9 @@ class MasonApiTestBase(object):
         assert method == "post"
         assert encoding == "json"
         body = self.valid_item_json()
-        validate(body, schema)
+        schema_validator(schema).validate(body)
         resp = client.post(href, json=body)
-        assert resp.status_code == 201
+        assert resp.status_code == HTTPStatus.CREATED
 
     def _check_control_put_method(self, ctrl, client, obj):
         """
@@ -382,35 +494,100 @@ class MasonApiTestBase(object):
         assert method == "put"
         assert encoding == "json"
         body = self.valid_json()
-        validate(body, schema)
+        schema_validator(schema).validate(body)
         resp = client.put(href, json=body)
-        assert resp.status_code == 204
+        assert resp.status_code == HTTPStatus.NO_CONTENT
 
-@pytest.fixture
-def client():
+def reset_app(app, db_snapshot):
+    """
+    Resets the app's state to what it was at the start of the test session.
+    The snapshot of the populated database is copied back into the app's
+    database, replacing whatever changes were made to it, and the response
+    cache is cleared.
+    """
+
+    with app.app_context():
+        connection = db.engine.raw_connection()
+        db_snapshot.backup(connection.driver_connection)
+        connection.close()
+        cache.clear()
+
+@pytest.fixture(scope="session")
+def app():
     """
-    Pytest fixture for setting up an app using a temporary SQLite database
-    file. Populates the database with test data and yields the test client to
-    be used in the each test.
+    Session scoped pytest fixture for setting up the app once for the whole
+    test session. Uses an in-memory SQLite database, and StaticPool makes all
+    sessions share the same connection, and thus the same database.
     """
 
-    db_fd, db_fname = tempfile.mkstemp()
     config = {
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+        "SQLALCHEMY_ENGINE_OPTIONS": {
+            "poolclass": StaticPool,
+            "connect_args": {"check_same_thread": False},
+        },
+        "CACHE_TYPE": "SimpleCache",
+        "SQLITE_PRAGMAS": {
+            "journal_mode": "MEMORY",
+            "synchronous": "OFF",
+            "temp_store": "MEMORY",
+            "locking_mode": "EXCLUSIVE",
+        },
         "TESTING": True
     }
-    
+
     app = create_app(config)
-    
+
+    yield app
+
+    with app.app_context():
+        db.engine.dispose()
+
+@pytest.fixture(scope="session")
+def db_snapshot(app):
+    """
+    Session scoped pytest fixture that creates the tables and populates them
+    with test data once for the whole test session. The populated database is
+    then copied into a separate in-memory SQLite database with SQLite's backup
+    API, and the connection to this snapshot is returned.
+    """
+
+    snapshot = sqlite3.connect(":memory:")
     with app.app_context():
         db.create_all()
         populate_db()
-        
-    yield app.test_client()
+        db.session.remove()
+        connection = db.engine.raw_connection()
+        connection.driver_connection.backup(snapshot)
+        connection.close()
+
+    yield snapshot
+
+    snapshot.close()
+
+@pytest.fixture(scope="session")
+def session_client(app):
+    """
+    Session scoped pytest fixture for creating one test client for the whole
+    test session. Cookies are disabled so that the client carries no state
+    from one test to the next.
+    """
+
+    return app.test_client(use_cookies=False)
+
+@pytest.fixture
+def client(app, db_snapshot, session_client):
+    """
+    Pytest fixture for resetting the app's state before each test with
+    *reset_app*. Yields the shared test client to be used in the each test.
+    """
+
+    reset_app(app, db_snapshot)
+
+    yield session_client
     
-    db.session.remove()
-    os.close(db_fd)
-    os.unlink(db_fname)
+    with app.app_context():
+        db.session.remove()
     
 def _random_map(i):
     """
@@ -420,8 +597,8 @@ def _random_map(i):
     return Map(
         name=f"Test Map {i}",
         slug=f"test-map-{i}",
-        width=random.randint(10, 50),
-        height=random.randint(10, 50),
+        width=RNG.randint(10, 50),
+        height=RNG.randint(10, 50),
     )
     
 def _random_observer(i, w, h):
@@ -433,9 +610,9 @@ def _random_observer(i, w, h):
     return Observer(
         name=f"Test Observer {i}",
         slug=f"test-observer-{i}",
-        x=random.randint(1, w - 2),
-        y=random.randint(1, h - 2),
-        vision=(None, round(random.random() * 100, 2))[random.randint(0, 1)]
+        x=RNG.randint(1, w - 2),
+        y=RNG.randint(1, h - 2),
+        vision=(None, round(RNG.random() * 100, 2))[RNG.randint(0, 1)]
     )
     
 def _random_obstacle(w, h):
@@ -445,8 +622,8 @@ def _random_obstacle(w, h):
     """
 
     return Obstacle(
-        x=random.randint(1, w - 2),
-        y=random.randint(1, h - 2),
+        x=RNG.randint(1, w - 2),
+        y=RNG.randint(1, h - 2),
     )
     
 def populate_db():
@@ -472,14 +649,17 @@ def populate_db():
         x=49,
         y=39
     )
-    fixed_map.observers.append(fixed_observer)
-    fixed_map.obstacles.append(fixed_obstacle)
-    fixed_map.observers.append(_random_observer(2, 50, 40))
-    fixed_map.obstacles.append(_random_obstacle(50, 40))
-    db.session.add(fixed_map)
-
-    for i in range(2, 4):
-        map = _random_map(i)
-        db.session.add(map)
+    children = [
+        fixed_observer,
+        fixed_obstacle,
+        _random_observer(2, 50, 40),
+        _random_obstacle(50, 40),
+    ]
+    maps = [fixed_map] + [_random_map(i) for i in range(2, 4)]
+
+    db.session.bulk_save_objects(maps, return_defaults=True)
+    for child in children:
+        child.map_id = fixed_map.id
+    db.session.bulk_save_objects(children)
     db.session.commit()
     